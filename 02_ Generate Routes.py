@@ -20,23 +20,31 @@
 # COMMAND ----------
 
 # DBTITLE 1,Install Required Libraries
-# MAGIC %pip install tabulate databricks-mosaic
+# MAGIC %pip install "databricks-mosaic<0.4" orjson
 
 # COMMAND ----------
 
 # DBTITLE 1,Import Required Libraries
 import requests
+import urllib3
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
 import json
+import orjson
 
 import itertools
 
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Tuple
+
+import socket
+import struct
 
 import pyspark.sql.functions as fn
 from pyspark.sql.types import *
+from pyspark.sql.pandas.types import to_arrow_type
 
 # mosaic import and configuration
 import mosaic as mos
@@ -44,8 +52,6 @@ spark.conf.set('spark.databricks.labs.mosaic.geometry.api', 'ESRI')
 spark.conf.set('spark.databricks.labs.mosaic.index.system', 'H3')
 mos.enable_mosaic(spark, dbutils)
 
-from tabulate import tabulate
-
 # COMMAND ----------
 
 # MAGIC %md ## Step 1: Verify Server Running on Each Worker
@@ -54,7 +60,7 @@ from tabulate import tabulate
 # MAGIC 
 # MAGIC To better understand this, it's helpful to know that the memory and processor resources available on each worker node are divided between Java Virtual Machines (JVMs).  These JVMs are referred to as *Executors* and are responsible for housing a subset of the data in a Spark RDD or Spark dataframe.  There is typically a one-to-one relationship between an Executor and a worker node but this is not always the case.
 # MAGIC 
-# MAGIC The [*sc.defaultParallelism*](https://spark.apache.org/docs/latest/api/python/reference/api/pyspark.SparkContext.defaultParallelism.html#pyspark.SparkContext.defaultParallelism) property keeps track of the number of processors availalbe across the worker nodes in a cluster, and by defining a Spark RDD using a parallelized range of values equivalent to this number, we are associating one integer value with each virtual core. The [*sc.runJob*](https://spark.apache.org/docs/latest/api/python/reference/api/pyspark.SparkContext.runJob.html) method then forces the the Python [*subprocess.run*](https://docs.python.org/3/library/subprocess.html#subprocess.run) method to run a local instance of the *hostname -I* command which retrieves the public IP address of the machine on which each of the value in the RDD. The output is returned as a list which is then transformed into a Python set to return just the unique IP values identified by the command.
+# MAGIC The [*sc.defaultParallelism*](https://spark.apache.org/docs/latest/api/python/reference/api/pyspark.SparkContext.defaultParallelism.html#pyspark.SparkContext.defaultParallelism) property keeps track of the number of processors availalbe across the worker nodes in a cluster, and by defining a Spark RDD using a parallelized range of values equivalent to this number, we are associating one integer value with each virtual core. The [*sc.runJob*](https://spark.apache.org/docs/latest/api/python/reference/api/pyspark.SparkContext.runJob.html) method then forces a function to run on the machine on which each of the values in the RDD resides.  This function [connects](https://docs.python.org/3/library/socket.html#socket.socket.connect) a UDP socket to the driver and then reads the IP address the socket is bound to using [*getsockname*](https://docs.python.org/3/library/socket.html#socket.socket.getsockname).  Connecting a UDP socket sends no data but does select the network interface through which the driver would be reached, giving us the address of the machine on the cluster's network.  (Resolving the machine's hostname would be simpler, but on many Linux images the hostname resolves to a loopback address such as 127.0.1.1.) The output is returned as a list which is then transformed into a Python set to return just the unique IP values identified by these calls.
 # MAGIC 
 # MAGIC While that sounds like a lot of explanation for such a simple task, please note that this same pattern will be coming into play with a different type of function call later in this notebook:
 
@@ -64,11 +70,21 @@ from tabulate import tabulate
 # generate RDD to span each executor on each worker
 myRDD = sc.parallelize(range(sc.defaultParallelism))
 
+# address of the driver which each worker can reach over the cluster's network
+driver_host = spark.conf.get('spark.driver.host')
+
+def get_ip_address(_):
+  
+  # connecting a udp socket sends nothing but binds it to the (non-loopback) address used to reach the driver
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+    s.connect((driver_host, 1))
+    return [s.getsockname()[0]]
+
 # get set of ip addresses
 ip_addresses = set( # conversion to set deduplicates output
   sc.runJob(
     myRDD, 
-    lambda _: [subprocess.run(['hostname','-I'], capture_output=True).stdout.decode('utf-8').strip()] # run hostname -I on each executor
+    get_ip_address # get ip address of each executor's host
     )
   )
 
@@ -118,16 +134,41 @@ nyc_taxi = (
   .format('delta')
   .load('dbfs:/databricks-datasets/nyctaxi/tables/nyctaxi_yellow/')
   .filter(fn.expr("pickup_datetime < '2016-01-01 00:00:00' AND dropoff_datetime > '2016-01-01 00:00:00'")) # stuck in cab at midnight on new years day
-  .filter(fn.expr('pickup_latitude is not null and dropoff_latitude is not null')) # valid coordinates
-  .withColumn('trip_meters', fn.expr('trip_distance * 1609.34'))
-  .withColumn('trip_seconds', fn.expr('datediff(second, pickup_datetime, dropoff_datetime)'))
+  .filter(fn.expr('pickup_longitude is not null and pickup_latitude is not null and dropoff_longitude is not null and dropoff_latitude is not null')) # valid coordinates
+  .selectExpr( # retain only the fields we need
+    'pickup_datetime',
+    'dropoff_datetime',
+    'pickup_longitude',
+    'pickup_latitude',
+    'dropoff_longitude',
+    'dropoff_latitude',
+    'trip_distance',
+    'fare_amount',
+    'trip_distance * 1609.34 as trip_meters',
+    'datediff(second, pickup_datetime, dropoff_datetime) as trip_seconds'
+    )
   )
 
 display(nyc_taxi.limit(10))
 
 # COMMAND ----------
 
+# MAGIC %md Because our filters are applied before any fields are selected or calculated, Spark is able to push them down into the scan of the Delta table, skipping files that cannot contain matching records and reading only the columns we've selected.  We can confirm this by locating the *PushedFilters* entry in the physical plan for the dataframe:
+
+# COMMAND ----------
+
+# DBTITLE 1,Verify Filter Pushdown
+nyc_taxi.explain()
+
+# COMMAND ----------
+
+# MAGIC %md As we will be returning to this data repeatedly throughout this notebook, we'll [cache](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.DataFrame.cache.html) it so that the Delta table is not re-read and our fields not re-calculated with each step.  Counting the rows in the dataset forces the cache to be populated:
+
+# COMMAND ----------
+
 # DBTITLE 1,Row Count for Dataset
+nyc_taxi = nyc_taxi.cache()
+
 nyc_taxi.count()
 
 # COMMAND ----------
@@ -171,60 +212,164 @@ nyc_taxi.count()
 # MAGIC * **tolls_amount** - Total amount of all tolls paid in trip.
 # MAGIC * **total_amount** - The total amount charged to passengers. Does not include cash tips.
 # MAGIC 
-# MAGIC In addition to these fields, we've calculated two fields, **trip_meters** and **trip_seconds**, to provide distance and duration information in a manner consistent with what we will receive from the OSRM Backend Server.
+# MAGIC Of these fields, we've retained only the pick-up and drop-off times and coordinates, the trip distance and the fare amount.  In addition to these fields, we've calculated two fields, **trip_meters** and **trip_seconds**, to provide distance and duration information in a manner consistent with what we will receive from the OSRM Backend Server.
 
 # COMMAND ----------
 
 # MAGIC %md ## Step 3: Get Trip Routes
 # MAGIC 
-# MAGIC The NYC Taxi dataset records the starting and ending point for each trip.  While we don't know the exact route, we can use the OSRM Backend Server [*route* method](http://project-osrm.org/docs/v5.5.1/api/#route-service) to identify a likely best route if that ride were to be taken today. To enable this, we'll write a function that will allow us to pass in the longitudes and latitudes for our pick-up and drop-off points for each trip.  This function will use that data to request a route from the OSRM Backend Server and return the resulting JSON document:
+# MAGIC The NYC Taxi dataset records the starting and ending point for each trip.  While we don't know the exact route, we can use the OSRM Backend Server [*route* method](http://project-osrm.org/docs/v5.5.1/api/#route-service) to identify a likely best route if that ride were to be taken today. To enable this, we'll write a function that will receive the longitudes and latitudes for our pick-up and drop-off points for each trip.  This function will use that data to request a route from the OSRM Backend Server and return the resulting JSON document.
+
+# COMMAND ----------
+
+# MAGIC %md Each request we send to the OSRM Backend Server travels over HTTP.  If we were to open a new connection with each request, much of the time spent retrieving a route would be consumed by establishing that connection.  Instead, we'll make use of a [connection pool](https://urllib3.readthedocs.io/en/stable/reference/urllib3.connectionpool.html) which keeps connections to the local server alive so that they may be re-used between requests.
+# MAGIC 
+# MAGIC Alongside the connection pool, we'll make use of a [thread pool](https://docs.python.org/3/library/concurrent.futures.html#threadpoolexecutor) with which we'll send multiple requests to the server at once.
+# MAGIC 
+# MAGIC Each of the functions we define below is handed all the batches of data in a partition, which Spark processes as a single task.  The functions create both pools when the task starts, re-use them across the batches of data in that partition and close them once the last batch has been processed.  Please note that we cannot hold onto these pools for longer than this.  Functions defined in a notebook are serialized and sent to the Executors with each task, so any state attached to them lives only as long as the task itself.  Creating the pools once per task rather than once per batch spares us from re-establishing connections and starting and stopping a set of threads with each batch of data:
+
+# COMMAND ----------
+
+# DBTITLE 1,Define Functions to Get Connection & Thread Pools
+def get_osrm_pool():
+  
+  # pool of connections to local osrm backend server (close when the task completes)
+  return urllib3.HTTPConnectionPool(host='127.0.0.1', port=5000, maxsize=64, block=False)
+
+def get_osrm_executor():
+  
+  # thread pool for sending requests concurrently (shut down when the task completes)
+  return ThreadPoolExecutor(max_workers=32)
 
 # COMMAND ----------
 
 # DBTITLE 1,Define Function to Get Route
-@fn.pandas_udf(StringType())
-def get_osrm_route(
-  start_longitudes: pd.Series, 
-  start_latitudes:pd.Series, 
-  end_longitudes: pd.Series, 
-  end_latitudes: pd.Series
-  ) -> pd.Series:
-   
-  # combine inputs to form dataframe
-  df = pd.concat([start_longitudes, start_latitudes, end_longitudes, end_latitudes], axis=1)
-  df.columns = ['start_lon','start_lat','end_lon','end_lat']
-
-  # internal function to get route for a given row
-  def _route(row):
-    r = requests.get(
-      f'http://127.0.0.1:5000/route/v1/driving/{row.start_lon},{row.start_lat};{row.end_lon},{row.end_lat}?alternatives=true&steps=false&geometries=geojson&overview=simplified&annotations=false'
-    )
-    return r.text
+# schema for the route document
+route_schema = StructType([
+  StructField('code',StringType()),
+  StructField('routes',ArrayType(
+    StructType([
+      StructField('distance',DoubleType()),
+      StructField('duration',DoubleType()),
+      StructField('geometry',BinaryType()),
+      StructField('legs',ArrayType(
+        StructType([
+          StructField('distance',DoubleType()),
+          StructField('duration',DoubleType()),
+          StructField('steps',ArrayType(StringType())),
+          StructField('summary',StringType()),
+          StructField('weight',DoubleType())
+          ])
+        )),
+      StructField('weight',DoubleType()),
+      StructField('weight_name',StringType())
+      ])
+    )),
+  StructField('waypoints',ArrayType(
+    StructType([
+      StructField('distance',DoubleType()),
+      StructField('hint',StringType()),
+      StructField('location',ArrayType(DoubleType())),
+      StructField('name',StringType())
+      ])
+    ))
+  ])
+
+# arrow representation of the route schema
+route_arrow_type = to_arrow_type(route_schema)
+
+def get_osrm_routes(batches):
+
+  # internal function to get route for a given request path
+  def _route(path):
+    route = orjson.loads(pool.request('GET', path).data)
+    
+    # convert geometry of each route from geojson to well-known binary (little-endian linestring)
+    for alternative in route.get('routes', []):
+      coordinates = alternative['geometry']['coordinates']
+      alternative['geometry'] = struct.pack('<BII', 1, 2, len(coordinates)) + np.array(coordinates, dtype='<f8').tobytes()
+    
+    return route
   
-  # apply routing function row by row
-  return df.apply(_route, axis=1)
+  # create connection and thread pools for the duration of this task
+  with get_osrm_pool() as pool, get_osrm_executor() as executor:
+  
+    for batch in batches:
+      
+      # access coordinates (already rounded to 5 decimal places) without copying
+      start_lon, start_lat, end_lon, end_lat = [
+        pd.Series(batch.column(c).to_numpy(zero_copy_only=True)).astype(str)
+        for c in ['s_lon','s_lat','e_lon','e_lat']
+        ]
+      
+      # form request path for each row
+      paths = (
+        '/route/v1/driving/' + 
+        start_lon + ',' + start_lat + ';' + end_lon + ',' + end_lat + 
+        '?alternatives=true&steps=false&geometries=geojson&overview=simplified&annotations=false'
+        )
+      
+      # send requests for all rows concurrently
+      routes = list(executor.map(_route, paths.tolist()))
+      
+      # return batch with parsed routes appended
+      yield pa.RecordBatch.from_arrays(
+        batch.columns + [pa.array(routes, type=route_arrow_type)],
+        names=batch.schema.names + ['osrm_route']
+        )
 
 # COMMAND ----------
 
 # MAGIC %md To understand this function, remember that the data in our dataframe has been divided into subsets (partitions) that are distributed across the Executors aligned with the virtual cores on the worker nodes on our cluster.  (Please see the explanation in the section above on retrieving IP addresses if you need an explanation of the concept of an Executor.)  When we apply this function to our Spark dataframe, it will be applied to each partition in a parallel manner depending on the parallelism of the dataframe itself.
 # MAGIC 
-# MAGIC Through the arguments specified for this function, values from each partition will be received.  Each argument is mapped to a column and multiple rows worth of values from each column are received as a pandas Series with each argument. The number of values received with the series depends on the partition size as well as the *spark.databricks.execution.pandasUDF.maxBatchesToPrefetch* configuration setting.
+# MAGIC The function receives the data in a partition as an iterator of [Apache Arrow](https://arrow.apache.org/docs/python/index.html) record batches, each of which holds multiple rows worth of values for each column in the dataframe. The number of rows in each batch depends on the partition size as well as the *spark.sql.execution.arrow.maxRecordsPerBatch* configuration setting.
+# MAGIC 
+# MAGIC For each batch, we access the pick-up and drop-off coordinates as numpy arrays which share their memory with the batch and form the request for every row in a single set of vectorized string operations.  Each request is then passed to an internally defined function which sends it to the local instance of the OSRM Backend Server using a connection from our connection pool.  Because the server is capable of handling many requests in parallel and because our function spends most of its time waiting on the server's response, we submit these requests to our thread pool so that the requests for all the rows in the batch are in flight at the same time.  The backend server returns routing information as a JSON document which we parse using the [orjson](https://github.com/ijl/orjson) library.  The parsed documents are converted into an Arrow array using the Arrow representation of the schema defined above and appended to the batch as a new column before the batch is handed back to the Spark engine.
 # MAGIC 
-# MAGIC The values in each series are sorted in the same order.  If we concatenate these series, we can recreate the rows of data found within the partition. To each row of the resulting pandas Dataframe, we apply an internally defined function makes a request to the local instance of the OSRM Backend Server.  The backend server returns routing information as a JSON string. That JSON string is returned for each row in the pandas Dataframe and the resulting series of returned values is sent from the outer function back to the Spark engine to be incorporated into the Spark dataframe.
+# MAGIC The NYC Taxi dataset contains many trips that start and end at the same points.  So that we can avoid asking the server for the same route over and over, the function expects the coordinates to have been rounded to 5 decimal places (about 1 meter, which is finer than the precision with which the server snaps points to the road network) in the *s_lon*, *s_lat*, *e_lon* and *e_lat* fields we will add to our data below.  The requests are formed directly from these rounded values.
 # MAGIC 
-# MAGIC This overall pattern of receiving a set of values as pandas Series for each argument defined in the user-defined function (UDF) and returning a corresponding set of results as a pandas Series is what makes this function a pandas Series-to-Series user-defined function.  You can read more about this type of pandas UDF [here](https://docs.databricks.com/spark/latest/spark-sql/udf-python-pandas.html).
+# MAGIC This overall pattern of receiving an iterator of Arrow record batches and yielding a corresponding set of record batches is what makes this function suitable for use with the [*mapInArrow*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.DataFrame.mapInArrow.html) method.  Working directly with Arrow data allows us to skip the conversion of each batch into pandas Series and back.  Please note that the *geometry* element of each route, which the server provides as a GeoJSON structure, is returned in the [well-known binary (WKB)](https://en.wikipedia.org/wiki/Well-known_text_representation_of_geometry#Well-known_binary) format.  We build this binary value directly from the coordinates already parsed from the response, which spares us from having to serialize and parse the geometry again when we later make use of it.  The binary value is also considerably smaller than its text-based equivalents, reducing the volume of data passed from Python back to the Spark engine.  (The conversion of Spark schemas to their Arrow representation also does not support a struct nested directly within another struct.)
+
+# COMMAND ----------
+
+# MAGIC %md The time required to route a trip is dominated by waiting on the OSRM Backend Server.  If our dataframe is divided into fewer partitions than there are virtual cores in our cluster, some of the cores will sit idle and the servers on the workers will receive fewer requests than they can handle.  And if a partition happens to contain a few long-running requests, the trips that follow them in that partition will be kept waiting.  To avoid this, we'll divide our data into a number of partitions several times larger than the number of virtual cores in our cluster so that each Executor has multiple batches of trips to work through.
 # MAGIC 
-# MAGIC To apply our pandas UDF to our data, we can simply use it in the context of a [*withColumn*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.DataFrame.withColumn.html) method call as follows:
+# MAGIC Before doing this, we round the pick-up and drop-off coordinates to 5 decimal places within Spark.  With every trip carrying these rounded values, Spark can identify the unique pairs of start and end points before any request is sent.  When we need routing information for the full dataset, we can retrieve it for these unique pairs only and then join the results back to our trips:
+
+# COMMAND ----------
+
+# DBTITLE 1,Balance Data Across Executors
+# round coordinates to 5 decimal places (approx. 1 meter)
+nyc_taxi_r = nyc_taxi.withColumns({
+  's_lon': fn.round('pickup_longitude', 5),
+  's_lat': fn.round('pickup_latitude', 5),
+  'e_lon': fn.round('dropoff_longitude', 5),
+  'e_lat': fn.round('dropoff_latitude', 5)
+  })
+
+# unique pairs of rounded start and end points
+unique_pairs = (
+  nyc_taxi_r
+    .select('s_lon','s_lat','e_lon','e_lat')
+    .dropDuplicates()
+    .repartition(sc.defaultParallelism * 4)
+  )
+
+nyc_taxi_balanced = nyc_taxi_r.repartition(sc.defaultParallelism * 4)
+
+# COMMAND ----------
+
+# MAGIC %md To apply our function to our data, we provide it to the [*mapInArrow*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.DataFrame.mapInArrow.html) method along with the schema of the data it returns, *i.e.* the schema of our dataframe with the *osrm_route* field appended:
 
 # COMMAND ----------
 
 # DBTITLE 1,Retrieve Routes
+# schema for trips with routes appended
+trip_routes_schema = StructType(nyc_taxi_balanced.schema.fields + [StructField('osrm_route', route_schema)])
+
 display(
-  nyc_taxi
-    .withColumn(
-      'osrm_route',
-      get_osrm_route('pickup_longitude','pickup_latitude','dropoff_longitude','dropoff_latitude')
-      )
+  nyc_taxi_balanced
+    .mapInArrow(get_osrm_routes, trip_routes_schema)
     .selectExpr(
       'pickup_datetime',
       'dropoff_datetime',
@@ -242,115 +387,169 @@ display(
 
 # COMMAND ----------
 
-# MAGIC %md The results of the function call is a JSON string.  We've returned it as a string as opposed to a complex data type simply because the pandas UDF does not have the ability to marshal all complex types between a pandas UDF and the Spark engine. So if we need to convert the string into a complex data representation, we need to do this once the function has completed its work. 
+# MAGIC %md Because the function has already parsed the JSON document, the results are received by Spark as a complex data type without any further conversion.  The structure of this document is defined by the OSRM Backend Server.  Its elements can be extracted using simple dot-notation references as we will see below.
 # MAGIC 
-# MAGIC For example, here we've provided a string-based representation of the JSON schema and have applied the [*from_json*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.functions.from_json.html#pyspark.sql.functions.from_json) function with this schema as an argument to convert the returned value into the desired complex type:
-# MAGIC 
-# MAGIC **NOTE** If you prefer to define a schema using the traditional PySpark data type representations, as will be shown later in this notebook, that works fine as well.
-
-# COMMAND ----------
-
-# DBTITLE 1,Convert Route JSON to Complex Data Type Representation
-# schema for the json document
-response_schema = '''
-  STRUCT<
-    code: STRING, 
-    routes: 
-      ARRAY<
-        STRUCT<
-          distance: DOUBLE, 
-          duration: DOUBLE, 
-          geometry: STRUCT<
-            coordinates: ARRAY<ARRAY<DOUBLE>>, 
-            type: STRING
-            >, 
-          legs: ARRAY<
-            STRUCT<
-              distance: DOUBLE, 
-              duration: DOUBLE, 
-              steps: ARRAY<STRING>, 
-              summary: STRING, 
-              weight: DOUBLE
-              >
-            >, 
-          weight: DOUBLE, 
-          weight_name: STRING
-          >
-        >,
-      waypoints: ARRAY<
-        STRUCT<
-          distance: DOUBLE, 
-          hint: STRING, 
-          location: ARRAY<DOUBLE>, 
-          name: STRING
-          >
-        >
-      >
-  '''
-
-# retrieve routes and convert json to struct
-nyc_taxi_routes = (
-  nyc_taxi
-  .withColumn(
-    'osrm_route',
-    get_osrm_route('pickup_longitude','pickup_latitude','dropoff_longitude','dropoff_latitude')
+# MAGIC But if all we need for a trip is the distance and duration of its route, requesting the full route is more than is required.  The OSRM Backend Server's [*table* method](http://project-osrm.org/docs/v5.5.1/api/#table-service) calculates the distances and durations between a set of source points and a set of destination points in a single request.  If we supply the pick-up points of a number of trips as our sources and the corresponding drop-off points as our destinations, the values on the diagonal of the returned matrices provide the distance and duration for each trip.  In this way, a single request to the server replaces one request per trip.  And as we have no use for the snapped source and destination points the server would normally return with the matrices, we ask the server to skip these, leaving a response that contains little more than the values we need:
+
+# COMMAND ----------
+
+# DBTITLE 1,Define Function to Get Route Distance & Duration
+# maximum number of sources and of destinations in a table request (must match --max-table-size in osrm-backend.sh)
+max_table_size = 100
+
+@fn.pandas_udf(
+  StructType([
+    StructField('distance',DoubleType()),
+    StructField('duration',DoubleType())
+    ])
+  )
+def get_osrm_durations(
+  batches: Iterator[Tuple[pd.Series, pd.Series, pd.Series, pd.Series]]
+  ) -> Iterator[pd.DataFrame]:
+
+  # internal function to read the diagonal of a matrix directly from the response body
+  def _diagonal(body, key, n):
+    values = []
+    position = body.index(key) + len(key)
+    for i in range(n):
+      start = body.index(b'[', position) + 1
+      end = body.index(b']', start)
+      position = end + 1
+      value = body[start:end].split(b',', i+1)[i].strip()
+      values.append(None if value == b'null' else float(value))
+    return values
+
+  # internal function to get distance and duration for a chunk of trips
+  def _table(chunk):
+    
+    points = ';'.join(chunk)
+    
+    # start points are at even and end points at odd positions in the list of points
+    sources = ';'.join(str(2*i) for i in range(len(chunk)))
+    destinations = ';'.join(str(2*i+1) for i in range(len(chunk)))
+    
+    r = pool.request(
+      'GET',
+      f'/table/v1/driving/{points}?sources={sources}&destinations={destinations}&annotations=duration,distance&skip_waypoints=true'
     )
+    
+    # values for each trip are found on the diagonal
+    try:
+      return list(zip(_diagonal(r.data, b'"distances":[', len(chunk)), _diagonal(r.data, b'"durations":[', len(chunk))))
+    
+    # fall back to parsing the full document if the body is not laid out as expected
+    except (ValueError, IndexError):
+      table = orjson.loads(r.data)
+    
+    # no table returned for this trip
+    if table['code'] != 'Ok' and len(chunk) == 1:
+      return [(None, None)]
+    
+    # no table returned for this chunk of trips, so split it in half and retry to isolate the failing trips
+    if table['code'] != 'Ok':
+      middle = len(chunk) // 2
+      return _table(chunk[:middle]) + _table(chunk[middle:])
+    
+    return [(table['distances'][i][i], table['durations'][i][i]) for i in range(len(chunk))]
+  
+  # create connection and thread pools for the duration of this task
+  with get_osrm_pool() as pool, get_osrm_executor() as executor:
+    
+    for start_longitudes, start_latitudes, end_longitudes, end_latitudes in batches:
+      
+      # form start;end pair of points for each trip
+      pairs = (
+        start_longitudes.astype(str) + ',' + start_latitudes.astype(str) + ';' + 
+        end_longitudes.astype(str) + ',' + end_latitudes.astype(str)
+        ).tolist()
+      
+      # divide trips into chunks that fit within a single table request
+      chunks = [pairs[i:i+max_table_size] for i in range(0, len(pairs), max_table_size)]
+      
+      # send requests for all chunks concurrently
+      results = list(itertools.chain.from_iterable(executor.map(_table, chunks)))
+      
+      yield pd.DataFrame(results, columns=['distance','duration'])
+
+# COMMAND ----------
+
+# MAGIC %md Unlike the function we used to retrieve routes, this function is a [pandas user-defined function](https://docs.databricks.com/spark/latest/spark-sql/udf-python-pandas.html).  Through the columns specified when calling this function, values from each partition will be received.  The function receives an iterator over the batches of data in a partition, each of which provides multiple rows worth of values from each column as a pandas Series.  The values in each series are sorted in the same order, allowing us to form the pair of points for each trip.  This pattern of receiving an iterator of pandas Series and yielding a corresponding set of results for each batch is what makes this function an [Iterator of Multiple Series to Iterator of Series](https://spark.apache.org/docs/latest/api/python/user_guide/sql/arrow_pandas.html#iterator-of-multiple-series-to-iterator-of-series-udf) pandas user-defined function.  As with our *get_osrm_routes* function, this allows the connection and thread pools to be created once for the partition rather than once for each batch.
+# MAGIC 
+# MAGIC The OSRM Backend Server limits the number of sources and destinations it will accept in a table request.  For this reason, the trips in each batch are divided into chunks of no more than *max_table_size* trips with each chunk sent as a separate request.  As we only need the values on the diagonal of each matrix, we read these directly from the body of the response instead of parsing every value in the matrices, falling back to a full parse of the document should the body not be laid out as expected, such as when the server returns an error.  A single invalid point, such as a latitude beyond 90 degrees, causes the server to reject the entire request, so when a chunk is rejected we split it in half and retry each half, repeating until only the failing trips remain to receive null values.  The results of the function are returned as a pandas Dataframe which Spark receives as a struct with *distance* and *duration* fields.
+# MAGIC 
+# MAGIC As we are retrieving distances and durations for every trip in our dataset, we apply this function to the unique pairs of rounded points identified above and join the results back to our trips.  Trips without a matching result, should there be any, simply receive null values.
+# MAGIC 
+# MAGIC Please note that because the join requires all of the results for the unique pairs, the display below will not return until every unique pair has been routed.  We cache these results so that they are calculated only once and are then available to any further work we perform with this data:
+
+# COMMAND ----------
+
+# DBTITLE 1,Retrieve Distance and Duration from Routes
+# retrieve route distances and durations for unique pairs of points
+unique_durations = (
+  unique_pairs
   .withColumn(
-    'osrm_route',
-    fn.from_json('osrm_route',response_schema)
+    'route',
+    get_osrm_durations('s_lon','s_lat','e_lon','e_lat')
     )
+  .cache() # retain results so that each unique pair is routed only once
+  )
+
+# join route distances and durations back to trips
+nyc_taxi_routes = (
+  nyc_taxi_r
+  .join(unique_durations, on=['s_lon','s_lat','e_lon','e_lat'], how='left')
+  .withColumn('route_meters', fn.col('route.distance'))
+  .withColumn('route_seconds', fn.col('route.duration'))
   .selectExpr(
     'pickup_datetime',
     'dropoff_datetime',
-    'osrm_route',
     'trip_meters',
-    'trip_seconds'
+    'route_meters',
+    'trip_seconds',
+    'route_seconds'
     )
   )
 
-
 display(
   nyc_taxi_routes.limit(10)
   )
 
 # COMMAND ----------
 
-# MAGIC %md The structure of the JSON document is defined by the OSRM Backend Server.  These elements can be extracted using simple dot-notation references:
+# MAGIC %md In addition to attributes such as distance and duration, the route information returned by the OSRM Backend Server contains a *geometry* element which adheres to the [GeoJSON format](https://datatracker.ietf.org/doc/html/rfc7946) and which our function has already converted into the standard WKB representation used by the [Databricks Mosaic](https://databricks.com/blog/2022/05/02/high-scale-geospatial-processing-with-mosaic.html) library's [geometry functions](https://databrickslabs.github.io/mosaic/api/geometry-constructors.html#st-geomfromwkb).  As such, no further conversion is required to work with this element.  As only the full route provides this element, this is the one place where we need to retrieve full routes using our *get_osrm_routes* function.  As before, we retrieve routes for the unique pairs of points, caching the results so that the visualization that follows does not send these requests to the server a second time:
 # MAGIC 
 # MAGIC **NOTE** Within the JSON document, routes is presented as an array even though there should be only one route per document.  The [*explode*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.functions.explode.html#pyspark.sql.functions.explode) function expands the array, duplicating the other fields around each element in the array.  With only one route in the routes array, this function call should not expand the size of the dataset.
 
 # COMMAND ----------
 
-# DBTITLE 1,Retrieve Distance and Duration from Routes
-display(
-   nyc_taxi_routes
-    .withColumn('route', fn.explode('osrm_route.routes'))
-    .withColumn('route_meters', fn.col('route.distance'))
-    .withColumn('route_seconds', fn.col('route.duration'))
+# DBTITLE 1,Get Route Geometry
+# schema for unique pairs of points with routes appended
+unique_routes_schema = StructType(unique_pairs.schema.fields + [StructField('osrm_route', route_schema)])
+
+# retrieve full routes for unique pairs of points
+unique_routes = (
+  unique_pairs
+    .mapInArrow(get_osrm_routes, unique_routes_schema)
+    .cache() # retain results so that each unique pair is routed only once
+  )
+
+nyc_taxi_geometry = (
+  nyc_taxi_r
+    .join( # join full routes back to trips
+      unique_routes,
+      on=['s_lon','s_lat','e_lon','e_lat'],
+      how='left'
+      )
+    .withColumn('route', fn.explode('osrm_route.routes')) # explode routes array
+    .withColumn('geom', fn.col('route.geometry')) # geometry is already wkb
     .selectExpr(
       'pickup_datetime',
       'dropoff_datetime',
       'trip_meters',
-      'route_meters',
       'trip_seconds',
-      'route_seconds'
+      'route',
+      'geom'
       )
-    .limit(10)
-  )
-
-# COMMAND ----------
-
-# MAGIC %md In addition to attributes such as distance and duration, the route information returned by the OSRM Backend Server contains a *geometry* element which adheres to the [GeoJSON format](https://datatracker.ietf.org/doc/html/rfc7946). Using the [Databricks Mosaic](https://databricks.com/blog/2022/05/02/high-scale-geospatial-processing-with-mosaic.html) library's [*st_geomfromgeojson*](https://databrickslabs.github.io/mosaic/api/geometry-constructors.html#st-geomfromgeojson) and [*st_aswkb*](https://databrickslabs.github.io/mosaic/api/geometry-accessors.html#st-aswkb) methods, we can convert this element into a standard representation:
-
-# COMMAND ----------
-
-# DBTITLE 1,Get Route Geometry
-nyc_taxi_geometry = (
-  nyc_taxi_routes
-    .withColumn('route', fn.explode('osrm_route.routes')) # explode routes array
-    .withColumn('geojson', fn.to_json(fn.col('route.geometry')))
-    .withColumn('geom', mos.st_aswkb(mos.st_geomfromgeojson('geojson')))
-    .drop('osrm_route')
   )
 
 display(nyc_taxi_geometry.limit(10))
@@ -377,28 +576,73 @@ display(nyc_taxi_geometry.limit(10))
 # DBTITLE 1,Get Driving Times Table
 @fn.pandas_udf(StringType())
 def get_driving_table(
-  points_arrays: pd.Series
-  ) -> pd.Series:
+  batches: Iterator[pd.Series]
+  ) -> Iterator[pd.Series]:
 
-  # internal function to get table for points in an array
-  def _table(points_array):
+  # internal function to get table between a shard of source points and a shard of destination points
+  def _shard_table(source_points, destination_points):
     
-    points = ';'.join(points_array)
+    points = ';'.join(source_points + destination_points)
+    sources = ';'.join(str(i) for i in range(len(source_points)))
+    destinations = ';'.join(str(len(source_points) + i) for i in range(len(destination_points)))
     
-    r = requests.get(
-      f'http://127.0.0.1:5000/table/v1/driving/{points}'
+    r = pool.request(
+      'GET',
+      f'/table/v1/driving/{points}?sources={sources}&destinations={destinations}'
     )
     
-    return r.text
+    return orjson.loads(r.data)
+
+  # internal function to get table for a semicolon-delimited list of points
+  def _table(points):
+    
+    # request table in a single call if points are within the server's limit
+    if points.count(';') < max_table_size:
+      r = pool.request(
+        'GET',
+        f'/table/v1/driving/{points}'
+      )
+      return r.data.decode('utf-8')
+    
+    # otherwise divide points into shards and request a table for each pair of shards
+    points = points.split(';')
+    shards = [points[i:i+max_table_size] for i in range(0, len(points), max_table_size)]
+    
+    # stitch tables for each pair of shards into a single table
+    table = {'code':'Ok', 'destinations':[], 'durations':[[] for _ in points], 'sources':[]}
+    for i, source_points in enumerate(shards):
+      for j, destination_points in enumerate(shards):
+        
+        shard_table = _shard_table(source_points, destination_points)
+        if shard_table['code'] != 'Ok':
+          return orjson.dumps(shard_table).decode('utf-8')
+        
+        for k, durations in enumerate(shard_table['durations']):
+          table['durations'][i * max_table_size + k] += durations
+        if i == 0:
+          table['destinations'] += shard_table['destinations']
+        if j == 0:
+          table['sources'] += shard_table['sources']
+    
+    return orjson.dumps(table).decode('utf-8')
   
-  # apply table function row by row
-  return points_arrays.apply(_table)
+  # create connection and thread pools for the duration of this task
+  with get_osrm_pool() as pool, get_osrm_executor() as executor:
+    
+    for points_lists in batches:
+      
+      # send requests for all rows concurrently
+      tables = list(executor.map(_table, points_lists))
+      
+      yield pd.Series(tables)
 
 # COMMAND ----------
 
-# MAGIC %md To call this function, we need to provide a collection of points.  The NYC Taxi data doesn't really provide a good means for this, let's arbitrarily that we needed to tackle all pickup points within 1 second intervals:
+# MAGIC %md The cost of a table grows with the product of the number of sources and the number of destinations, and the OSRM Backend Server will refuse any request with more than *max_table_size* sources and destinations.  So that a large collection of points neither fails nor holds up the other requests on an Executor, the function divides any collection larger than this limit into shards, requests a table for each pair of shards and stitches the results together into a single table.
 # MAGIC 
-# MAGIC **NOTE** The aggregation in this example is contrived simply to demonstrate how values are passed to the *get_driving_table* function defined above.
+# MAGIC To call this function, we need to provide a collection of points.  The NYC Taxi data doesn't really provide a good means for this, let's arbitrarily that we needed to tackle all pickup points within 1 second intervals:
+# MAGIC 
+# MAGIC **NOTE** The aggregation in this example is contrived simply to demonstrate how values are passed to the *get_driving_table* function defined above.  The points for each interval are collected as numeric longitude and latitude pairs and only once collected are they formatted and joined into the semicolon-delimited list expected by the *table* method using Spark's [*transform*](https://spark.apache.org/docs/latest/api/sql/index.html#transform) and [*array_join*](https://spark.apache.org/docs/latest/api/python/reference/pyspark.sql/api/pyspark.sql.functions.array_join.html) functions so that the function only needs to send the request.
 
 # COMMAND ----------
 
@@ -429,12 +673,12 @@ response_schema = StructType([
 # retrieve driving table and extract matrix
 driving_tables = (
   nyc_taxi
-  .withColumn('pickup_point', fn.expr("concat(pickup_longitude,',',pickup_latitude)"))
   .withColumn('pickup_window', fn.expr("window(pickup_datetime, '1 SECONDS')"))
   .groupBy('pickup_window')
-    .agg(fn.collect_set('pickup_point').alias('pickup_points'))
+    .agg(fn.collect_set(fn.struct('pickup_longitude','pickup_latitude')).alias('pickup_points'))
   .filter(fn.expr('size(pickup_points) > 1')) # more than one point required for table
-  .withColumn('driving_table', get_driving_table('pickup_points'))
+  .withColumn('pickup_points_str', fn.expr("array_join(transform(pickup_points, p -> concat(p.pickup_longitude, ',', p.pickup_latitude)), ';')")) # semicolon-delimited list of points
+  .withColumn('driving_table', get_driving_table('pickup_points_str'))
   .withColumn('driving_table', fn.from_json('driving_table', response_schema))
   .withColumn('driving_table_durations', fn.col('driving_table.durations'))
   )  
@@ -449,15 +693,18 @@ display(driving_tables.limit(10))
 
 # DBTITLE 1,Display a Single Driving Table
 # generate a single table
-driving_table = driving_tables.limit(1).collect()[0]['driving_table_durations']
+driving_table = driving_tables.select('driving_table_durations').take(1)[0]['driving_table_durations']
 
 # print driving table
 print(
-    tabulate(
-      np.array(driving_table),
-      tablefmt='grid'
-      )
+  np.array2string(
+    np.asarray(driving_table, dtype=np.float32), # unreachable destinations (null) become nan
+    precision=1,
+    suppress_small=True,
+    separator=' | ',
+    max_line_width=200
     )
+  )
 
 # COMMAND ----------
 
@@ -472,6 +719,19 @@ print(
 # MAGIC * [tile](http://project-osrm.org/docs/v5.5.1/api/#tile-service) - generates Mapbox Vector Tiles that can be viewed with a vector-tile capable slippy-map viewer
 # MAGIC 
 # MAGIC To make any of these accessible during Spark dataframe processing, simply construct a pandas UDF around the HTTP REST API call as demonstrated above, return the resulting JSON as a string, and apply the appropriate schema to the result as demonstrted in the previous examples.
+# MAGIC 
+# MAGIC **NOTE** The OSRM project also provides [*libosrm*](https://github.com/Project-OSRM/osrm-backend/blob/master/docs/libosrm.md), a C++ library through which these same methods can be called in-process, bypassing HTTP altogether.  We've elected to stay with the REST API in this accelerator.  Calling *libosrm* from a pandas UDF would require a Python binding compiled against the same version of the OSRM software used to prepare the map files, and each Python process on a worker would need access to the map data in its own memory (or through shared memory loaded with *osrm-datastore*) alongside the server the init script already launches.  Instead, we've limited the overhead of the HTTP layer through the re-use of connections and the issuing of concurrent requests shown above.
+
+# COMMAND ----------
+
+# MAGIC %md With our work complete, we can release the cached NYC Taxi data along with the cached routing results:
+
+# COMMAND ----------
+
+# DBTITLE 1,Release Cached Data
+unique_routes.unpersist()
+unique_durations.unpersist()
+nyc_taxi.unpersist()
 
 # COMMAND ----------
 
@@ -483,4 +743,4 @@ print(
 # MAGIC |----------------------------------------|-------------------------|------------|-----------------------------------------------------|
 # MAGIC | OSRM Backend Server                                  | High performance routing engine written in C++14 designed to run on OpenStreetMap data | BSD 2-Clause "Simplified" License    | https://github.com/Project-OSRM/osrm-backend                   |
 # MAGIC | Mosaic | An extension to the Apache Spark framework that allows easy and fast processing of very large geospatial datasets | Databricks License| https://github.com/databrickslabs/mosaic | 
-# MAGIC | Tabulate | pretty-print tabular data in Python | MIT License | https://pypi.org/project/tabulate/ |
+# MAGIC | orjson | Fast, correct Python JSON library | Apache License 2.0 | https://pypi.org/project/orjson/ |